@@ -22,13 +22,69 @@ get_text
 Author: Yujian Tang
 '''
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+import atexit
 import click
 import json
-import pprint
+import mmap
+import os
+import functools
+import itertools
+import operator
+import pathlib
+import re
 import sys
 from time import sleep
+from types import MappingProxyType
+from concurrent.futures import ThreadPoolExecutor
 from configure import auth_key
 
+'''
+orjson parses and writes json much faster than the standard library,
+but it's an extra install, so we fall back to json if it's missing.
+Either way json_loads takes bytes, str, or an mmap and json_dumps
+returns bytes, pass indent=True to get it indented by two spaces
+'''
+try:
+    import orjson
+
+    def json_loads(data):
+        if isinstance(data, mmap.mmap):
+            with memoryview(data) as view:
+                return orjson.loads(view)
+        return orjson.loads(data)
+
+    def json_dumps(obj, indent=False):
+        option = orjson.OPT_NON_STR_KEYS
+        if indent:
+            option |= orjson.OPT_INDENT_2
+        return orjson.dumps(obj, option=option)
+except ImportError:
+    def json_loads(data):
+        if isinstance(data, mmap.mmap):
+            data = data[:]
+        return json.loads(data)
+
+    def json_dumps(obj, indent=False):
+        return json.dumps(obj, indent=2 if indent else None).encode()
+
+'''
+echo_json prints an object as indented json, this is much faster than
+pprint for a large transcript since the formatting happens in orjson
+'''
+def echo_json(obj):
+    click.echo(json_dumps(obj, indent=True).decode())
+
+'''
+save_json serializes the whole object to bytes before opening the file,
+so a serialization error never leaves a half written file behind
+'''
+def save_json(filename, obj):
+    data = json_dumps(obj)
+    with open(filename, 'wb') as w:
+        w.write(data)
+
 '''
 @click.group(<name>) creates a command that instantiates a group class
 a group is intended to be a set of related commands
@@ -38,15 +94,26 @@ and referring to that argument in the function by the name we pass it
 the context, the context is not visible to the command unless we pass this
 
 In our example we'll name our group "cli"
+
+Large documents are memory mapped so the json parser can read them
+straight from the page cache instead of from a copy of the whole file.
+Setting up a mapping isn't worth it for small documents (and empty files
+can't be mapped at all), so anything under MMAP_THRESHOLD is read in one
+go through a 1 MiB buffer
 '''
+MMAP_THRESHOLD = 1 << 20
+
 @click.group("cli")
 @click.pass_context
 @click.argument("document")
 def cli(ctx, document):
     """An example CLI for interfacing with a document"""
-    _stream = open(document)
-    _dict = json.load(_stream)
-    _stream.close()
+    with open(document, 'rb', buffering=1 << 20) as _stream:
+        if os.fstat(_stream.fileno()).st_size >= MMAP_THRESHOLD:
+            with mmap.mmap(_stream.fileno(), 0, access=mmap.ACCESS_READ) as _map:
+                _dict = json_loads(_map)
+        else:
+            _dict = json_loads(_stream.read())
     ctx.obj = _dict
 
 '''
@@ -59,7 +126,7 @@ which we expect to be a json looking dictionary
 @cli.command("check_context_object")
 @click.pass_context
 def check_context(ctx):
-    pprint.pprint(type(ctx.obj))
+    click.echo(type(ctx.obj).__name__)
 
 '''
 Here we'll make a pass decorator, which we can use to pass
@@ -88,7 +155,7 @@ def get_keys(_dict):
 @click.argument("key")
 @click.pass_context
 def get_key(ctx, key):
-    pprint.pprint(ctx.obj[key])
+    echo_json(ctx.obj[key])
 
 '''
 @click.option(<one dash usage>, <two dash usage>, is_flag (optional), help = <help>)
@@ -98,7 +165,54 @@ We'll create a function that gets the "results" of our dictionary
 and we will pass it two optional arguments, one to specify that
 we want a specific key from the results, and a flag to indicate
 whether or not we want to save our results to a json file
+
+We collect the values for our key into a list first and join them at
+the end, adding strings together one at a time gets slow quickly.
+merge_kind tells us whether the values are all strings or all lists,
+which merge_values can join in one go, or neither, in which case we fall
+back to adding them together. When we're downloading strings or lists,
+save_merged_json writes each value straight to the file instead, so we
+never hold the joined value in memory
 '''
+def merge_kind(values):
+    if all(isinstance(value, str) for value in values):
+        return str
+    if all(isinstance(value, list) for value in values):
+        return list
+    return None
+
+def merge_values(values):
+    kind = merge_kind(values)
+    if kind is str:
+        return ''.join(values)
+    if kind is list:
+        return list(itertools.chain.from_iterable(values))
+    return functools.reduce(operator.add, values)
+
+def save_merged_json(filename, key, values):
+    kind = merge_kind(values)
+    if kind is None:
+        save_json(filename, {key: merge_values(values)})
+        return
+    with open(filename, 'wb') as w:
+        w.write(b'{' + json_dumps(key) + b':')
+        if kind is str:
+            w.write(b'"')
+            for value in values:
+                w.write(json_dumps(value)[1:-1])
+            w.write(b'"')
+        else:
+            w.write(b'[')
+            first = True
+            for value in values:
+                if value:
+                    if not first:
+                        w.write(b',')
+                    w.write(json_dumps(value)[1:-1])
+                    first = False
+            w.write(b']')
+        w.write(b'}')
+
 @cli.command("get_results")
 @click.option("-d", "--download", is_flag=True, help="Pass to download the result to a json file")
 @click.option("-k", "--key", help="Pass a key to specify that key from the results")
@@ -106,24 +220,24 @@ whether or not we want to save our results to a json file
 def get_results(ctx, download: bool, key: str):
     results = ctx.obj['results']
     if key is not None:
-        result = {}
-        for entry in results:
-            if key in entry:
-                if key in result:
-                    result[key] += entry[key]
-                else:
-                    result[key] = entry[key]
-        results = result
+        buf = [entry[key] for entry in results if key in entry]
     if download:
         if key is not None:
             filename = key+'.json'
+            if buf:
+                save_merged_json(filename, key, buf)
+            else:
+                save_json(filename, {})
         else:
             filename = "results.json"
-        with open(filename, 'w') as w:
-            w.write(json.dumps(results))
+            save_json(filename, results)
         print("File saved to", filename)
     else:
-        pprint.pprint(results)
+        if key is not None:
+            results = {}
+            if buf:
+                results[key] = merge_values(buf)
+        echo_json(results)
 
 '''
 click.invoke(<command>, <args>) is click's way of letting us
@@ -146,7 +260,13 @@ of passing the whole context, it only passes context.obj
 We'll do something fun with our text extractor, we'll include
 options to extract as either paragraphs or sentences, and 
 default to returning one big block of text
+
+A sentence is a run of text ending in ".", "!", or "?" (or the end of
+the text). SENTENCE is compiled once when the module loads, and we scan
+each entry's text with it directly instead of joining everything first
 '''
+SENTENCE = re.compile(r'\s*([^.!?\s][^.!?]*(?:[.!?]+|$))')
+
 @cli.command("get_text")
 @click.option("-s", "--sentences", is_flag=True, help="Pass to return sentences")
 @click.option("-p", "--paragraphs", is_flag=True, help="Pass to return paragraphs")
@@ -154,32 +274,25 @@ default to returning one big block of text
 @click.pass_obj
 def get_text(_dict, sentences, paragraphs, download):
     """Returns the text as sentences, paragraphs, or one block by default"""
+    if sentences and paragraphs:
+        raise click.UsageError("Pass either --sentences or --paragraphs, not both")
     results = _dict['results']
-    text = {}
-    for idx, entry in enumerate(results):
-        if paragraphs:
-            text[idx] = entry['text']
-        else:
-            if 'text' in text:
-                text['text'] += entry['text']
-            else:
-                text['text'] = entry['text']
     if sentences:
-        sentences = text['text'].split('.')
-        for i in range(len(sentences)):
-            if sentences[i] != '':
-                text[i] = sentences[i]
-        del text['text']
-    pprint.pprint(text)
+        found = itertools.chain.from_iterable(SENTENCE.findall(entry['text']) for entry in results)
+        text = {i: s.strip() for i, s in enumerate(found)}
+    elif paragraphs:
+        text = {idx: entry['text'] for idx, entry in enumerate(results)}
+    else:
+        text = {'text': ''.join(entry['text'] for entry in results)}
+    echo_json(text)
     if download:
-        if paragraphs:
-            filename = "paragraphs.json"
-        elif sentences:
+        if sentences:
             filename = "sentences.json"
+        elif paragraphs:
+            filename = "paragraphs.json"
         else:
             filename = "text.json"
-        with open(filename, 'w') as w:
-            w.write(json.dumps(results))
+        save_json(filename, text)
         print("File saved to", filename)
 
 '''
@@ -191,75 +304,194 @@ same file.
 '''
 transcript_endpoint = "https://api.assemblyai.com/v2/transcript"
 upload_endpoint = 'https://api.assemblyai.com/v2/upload'
-headers = {
+headers = MappingProxyType({
     "authorization": auth_key,
     "content-type": "application/json"
-}
-CHUNK_SIZE = 5242880
+})
+UPLOAD_TIMEOUT = (10, None)
+UPLOAD_RETRIES = 3
+REQUEST_TIMEOUT = (5, 60)
+
+'''
+requests.Session() keeps the connection to AssemblyAI open between calls,
+so we only pay for the TLS handshake once per run instead of once for
+every upload, transcript request, and poll. The session also carries our
+headers, so we don't need to pass them in to every call, and headers
+itself is read only so nothing can change the auth key behind our back
+
+Retry has urllib3 quietly try again when a request fails to connect or
+comes back rate limited or with a server error, backing off a little
+longer each time, so a brief network hiccup doesn't lose our transcript.
+Retry leaves POSTs alone unless they never managed to connect, resending
+a transcript request the server may already have received could start
+(and bill) a duplicate job. The upload is safe to resend, so upload_file
+retries it itself
+
+Every call other than the upload gets 5 seconds to connect and 60 seconds
+to respond, so a stalled connection gets retried instead of hanging forever
+'''
+SESSION = requests.Session()
+SESSION.headers.update(headers)
+RETRY = Retry(
+    total=5,
+    backoff_factor=1.0,
+    status_forcelist=[429, 500, 502, 503, 504]
+)
+SESSION.mount("https://", HTTPAdapter(
+    pool_connections=4,
+    pool_maxsize=8,
+    max_retries=RETRY
+))
+atexit.register(SESSION.close)
+
+'''
+upload_file hands the open file straight to requests, which reads it in
+blocks as it sends and can set the Content-Length header up front since
+it knows the file's size. The upload gets 10 seconds to connect but no
+read timeout, since large files can take a while to send
+
+If the upload fails or comes back with one of RETRY's status codes, we
+rewind the file and send it again, up to UPLOAD_RETRIES more times
+'''
+def upload_file(location):
+    with open(location, 'rb') as _file:
+        for attempt in range(UPLOAD_RETRIES + 1):
+            if attempt:
+                sleep(RETRY.backoff_factor * 2 ** attempt)
+                _file.seek(0)
+            try:
+                upload_response = SESSION.post(upload_endpoint, data=_file, timeout=UPLOAD_TIMEOUT)
+            except requests.exceptions.RequestException:
+                if attempt == UPLOAD_RETRIES:
+                    raise
+                continue
+            if upload_response.status_code not in RETRY.status_forcelist:
+                break
+    upload_response.raise_for_status()
+    return upload_response.json()['upload_url']
+
+'''
+Rather than waiting a fixed 30 seconds between status checks, we start
+polling quickly and back off by 1.5x each time up to a maximum delay,
+so short clips finish as soon as they're ready. The delays can be tuned
+with the --min-delay and --max-delay options, both must be at least 0.1
+seconds so we never poll AssemblyAI in a tight loop
+
+wait_for_transcript returns the parsed transcript, or None if AssemblyAI
+is still unreachable after SESSION's retries. If AssemblyAI tells us the
+transcription failed it raises TranscriptionError, which the assembly
+command turns into an error message for the user
+'''
+class TranscriptionError(Exception):
+    pass
+
+def wait_for_transcript(polling_endpoint, min_delay=1.0, max_delay=30.0):
+    delay = min_delay
+    while True:
+        try:
+            payload = SESSION.get(polling_endpoint, timeout=REQUEST_TIMEOUT).json()
+        except requests.exceptions.RequestException:
+            return None
+        if payload['status'] == 'completed':
+            return payload
+        if payload['status'] == 'error':
+            raise TranscriptionError(str(payload.get('error')))
+        print("Transcript processing ...")
+        sleep(delay)
+        delay = min(delay * 1.5, max_delay)
 
 @click.group("assembly")
 @click.pass_context
 @click.argument("location")
-def assembly(ctx, location):
+@click.option("--min-delay", default=1.0, type=click.FloatRange(min=0.1), help="Seconds to wait before the first status check")
+@click.option("--max-delay", default=30.0, type=click.FloatRange(min=0.1), help="Maximum seconds to wait between status checks")
+def assembly(ctx, location, min_delay: float, max_delay: float):
     """A CLI for interacting with AssemblyAI"""
-    def read_file(location):
-        with open(location, 'rb') as _file:
-            while True:
-                data = _file.read(CHUNK_SIZE)
-                if not data:
-                    break
-                yield data
-            
-    upload_response = requests.post(
-        upload_endpoint,
-        headers=headers, data=read_file(location)
-    )
-    audio_url = upload_response.json()['upload_url']
+    if min_delay > max_delay:
+        raise click.BadParameter("must not be greater than --max-delay", param_hint="--min-delay")
+    audio_url = upload_file(location)
     print('Uploaded to', audio_url)
     transcript_request = {
         'audio_url': audio_url,
         'iab_categories': 'True',
     }
 
-    transcript_response = requests.post(transcript_endpoint, json=transcript_request, headers=headers)
+    transcript_response = SESSION.post(transcript_endpoint, json=transcript_request, timeout=REQUEST_TIMEOUT)
     transcript_id = transcript_response.json()['id']
     polling_endpoint = transcript_endpoint + "/" + transcript_id
     print("Transcribing at", polling_endpoint)
-    polling_response = requests.get(polling_endpoint, headers=headers)
-    while polling_response.json()['status'] != 'completed':
-        sleep(30)
-        print("Transcript processing ...")
-        try:
-            polling_response = requests.get(polling_endpoint, headers=headers)
-        except:
-            print("Expected to wait 30 percent of the length of your video")
-            print("After wait time is up, call poll with id", transcript_id)
-            return transcript_id
+    try:
+        payload = wait_for_transcript(polling_endpoint, min_delay, max_delay)
+    except TranscriptionError as error:
+        raise click.ClickException("Transcription failed: " + str(error))
+    if payload is None:
+        print("Expected to wait 30 percent of the length of your video")
+        print("After wait time is up, call poll with id", transcript_id)
+        return transcript_id
     categories_filename = transcript_id + '_categories.json'
-    with open(categories_filename, 'w') as f:
-        f.write(json.dumps(polling_response.json()['iab_categories_result']))
+    save_json(categories_filename, payload['iab_categories_result'])
     print('Categories saved to', categories_filename)
-    ctx.obj = polling_response.json()['id']
+    ctx.obj = payload['id']
+
+def get_transcript_part(transcript_id, part):
+    part_endpoint = transcript_endpoint + "/" + transcript_id + "/" + part
+    return SESSION.get(part_endpoint, timeout=REQUEST_TIMEOUT).json()
 
 @assembly.command("get_sentences")
 @click.pass_context
 def get_sentences(ctx):
-    sentences_endpoint = transcript_endpoint + "/" + ctx.obj + "/sentences"
-    sentences_response = requests.get(sentences_endpoint, headers=headers)
-    pprint.pprint(sentences_response.json())
+    echo_json(get_transcript_part(ctx.obj, "sentences"))
 
 @assembly.command("get_paragraphs")
 @click.pass_context
 def get_paragraphs(ctx):
-    paragraphs_endpoint = transcript_endpoint + "/" + ctx.obj + "/paragraphs"
-    paragraphs_response = requests.get(paragraphs_endpoint, headers=headers)
-    pprint.pprint(paragraphs_response.json())
+    echo_json(get_transcript_part(ctx.obj, "paragraphs"))
+
+'''
+If we want both the sentences and the paragraphs, there's no reason to
+wait for one request to finish before starting the other. We send both
+at once from a thread pool, they share SESSION's connection pool, so the
+total wait is about as long as the slower of the two. Both come back in
+one json object under "sentences" and "paragraphs"
+'''
+@assembly.command("get_transcript_parts")
+@click.pass_context
+def get_transcript_parts(ctx):
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        sentences = executor.submit(get_transcript_part, ctx.obj, "sentences")
+        paragraphs = executor.submit(get_transcript_part, ctx.obj, "paragraphs")
+        echo_json({"sentences": sentences.result(), "paragraphs": paragraphs.result()})
+
+'''
+main picks which group of commands to run from the extension of the
+file we're given, any other audio formats can be added to DISPATCH
+
+Since the file has to come first, main also moves any of the group's own
+options that follow it (like --min-delay 2) in front of it, click stops
+reading a group's options once it sees the file
+'''
+DISPATCH = {
+    '.json': (cli, "cli"),
+    '.mp3': (assembly, "assembly"),
+    '.wav': (assembly, "assembly"),
+    '.m4a': (assembly, "assembly"),
+    '.flac': (assembly, "assembly"),
+}
 
 def main():
-    if ".json" in sys.argv[1]:
-        cli(prog_name="cli")
-    if ".mp3" in sys.argv[1]:
-        assembly(prog_name="assembly")
+    ext = pathlib.Path(sys.argv[1]).suffix.lower()
+    if ext not in DISPATCH:
+        sys.exit("Expected a file ending in one of: " + ", ".join(sorted(DISPATCH)))
+    group, name = DISPATCH[ext]
+    options = {opt: param for param in group.params if isinstance(param, click.Option) for opt in param.opts}
+    args = sys.argv[1:]
+    end = 1
+    while end < len(args):
+        option = args[end].split('=', 1)[0]
+        if option not in options:
+            break
+        end += 1 if '=' in args[end] or options[option].is_flag else 2
+    group(args=args[1:end] + args[:1] + args[end:], prog_name=name)
 
 if __name__ == '__main__':
     main()
\ No newline at end of file